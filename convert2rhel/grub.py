@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import errno
+import fcntl
+import io
 import logging
 import os
 import re
@@ -52,6 +55,32 @@ is provided by the shim rpm which does not have to be installed on the system.
 In case it's missing, another files should be used instead.
 """
 
+GRUB_REQUIRED_EFI_FILENAMES = ("grubenv", "grub.cfg")
+"""Filenames of the GRUB files that have to be present in the UEFI directory."""
+
+GRUB_OPTIONAL_EFI_FILENAMES = ("user.cfg",)
+"""Filenames of the GRUB files that could be present in the UEFI directory."""
+
+_DEFAULT_RHEL_EFIBIN_PATHS = tuple(
+    (filename, os.path.join(RHEL_EFIDIR_CANONICAL_PATH, filename)) for filename in DEFAULT_INSTALLED_EFIBIN_FILENAMES
+)
+"""Pairs of (filename, canonical path) of the default UEFI binaries in the RHEL UEFI directory."""
+
+COPY_BUFSIZE = 256 * 1024
+"""Size of the buffer (in bytes) used when copying files on the ESP in the userspace."""
+
+_KERNEL_COPY_CHUNK_SIZE = 2**30
+"""Maximum number of bytes requested from the kernel by a single copy syscall."""
+
+_KERNEL_COPY_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP)
+"""Errors of copy syscalls meaning the copy has to be done by another method."""
+
+_FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+"""The ioctl request to share the file content (reflink) on copy-on-write filesystems.
+
+Exposed by the fcntl module since Python 3.12 only.
+"""
+
 
 class BootloaderError(Exception):
     """The generic error related to this module."""
@@ -319,6 +348,131 @@ def canonical_path_to_efi_format(canonical_path):
     return canonical_path.replace(EFI_MOUNTPOINT[:-1], "").replace("/", "\\")
 
 
+def _get_dir_entries(directory):
+    """Return the set of lowercased names of entries inside the directory.
+
+    The directory is read just once, so checking presence of multiple files
+    inside does not need a stat() call per file. The names are lowercased
+    as the ESP is a FAT filesystem, which is case-insensitive; e.g. the
+    GRUB.CFG file is the grub.cfg file there. Check presence of a file using
+    its lowercased name.
+
+    Return an empty set if the directory does not exist or cannot be read.
+    """
+    try:
+        return set(name.lower() for name in os.listdir(directory))
+    except OSError:
+        return set()
+
+
+def _reflink(src_fd, dst_fd):
+    """Make the destination file share the content of the source file.
+
+    Only the metadata are written on copy-on-write filesystems (e.g. btrfs or
+    XFS with reflink), no data are copied.
+
+    Return False when the filesystem does not support it (e.g. vfat, which is
+    usually used for the ESP) so another copy method can be used.
+    Raise OSError (or IOError on Python 2) on other errors.
+    """
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    except (OSError, IOError) as err:
+        # IOError for py2 and OSError for py3
+        if err.errno in _KERNEL_COPY_UNSUPPORTED_ERRNOS + (errno.ENOTTY,):
+            return False
+        raise
+    return True
+
+
+def _kernel_copy(copy_func, src_fd, dst_fd):
+    """Copy the file content by repeated calls of the copy_func syscall wrapper.
+
+    The copy_func(src_fd, dst_fd, offset) is expected to return the number of
+    copied bytes, zero when the end of the source file is reached.
+
+    Return False when the syscall is not supported for the given files and
+    nothing has been copied, so another copy method can be used. That includes
+    the case when nothing is copied from a non-empty file without any error,
+    as copy_file_range() does on some kernels and filesystems.
+    Raise OSError on other errors.
+    """
+    offset = 0
+    while True:
+        try:
+            size = copy_func(src_fd, dst_fd, offset)
+        except OSError as err:
+            if offset == 0 and err.errno in _KERNEL_COPY_UNSUPPORTED_ERRNOS:
+                return False
+            raise
+        if not size:
+            return offset != 0 or os.fstat(src_fd).st_size == 0
+        offset += size
+
+
+def _copy_file_range(src_fd, dst_fd, offset):
+    return os.copy_file_range(src_fd, dst_fd, _KERNEL_COPY_CHUNK_SIZE, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset):
+    return os.sendfile(dst_fd, src_fd, offset, _KERNEL_COPY_CHUNK_SIZE)
+
+
+def _buffered_copy(src, dst):
+    """Copy the file content through a single preallocated COPY_BUFSIZE buffer.
+
+    The files are expected to be unbuffered, so a single write() could write
+    just a part of the data (e.g. when the filesystem is getting full).
+    """
+    buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            break
+        written = 0
+        while written < size:
+            written += dst.write(view[written:size])
+
+
+def _copy_file(src_path, dst_path):
+    """Copy the file content and its metadata like shutil.copy2() does.
+
+    The content is shared with the source file when the filesystem supports
+    reflinks. Otherwise it is copied inside the kernel when possible, without
+    moving the data through the userspace: copy_file_range() is tried first
+    (Python >= 3.8), then sendfile() (Python >= 3.3). Otherwise, e.g. on
+    Python 2, the content is copied through a COPY_BUFSIZE buffer to keep
+    the number of read/write syscalls low. The ESP could be located on a slow
+    media and shutil uses just a 16KiB buffer on older Pythons.
+
+    Raise OSError (or IOError on Python 2) when the copy fails or when the
+    copied file is not complete.
+    """
+    kernel_copy_funcs = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copy_funcs.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        kernel_copy_funcs.append(_sendfile)
+
+    with io.open(src_path, "rb", buffering=0) as src:
+        with io.open(dst_path, "wb", buffering=0) as dst:
+            if not _reflink(src.fileno(), dst.fileno()):
+                for copy_func in kernel_copy_funcs:
+                    if _kernel_copy(copy_func, src.fileno(), dst.fileno()):
+                        break
+                else:
+                    _buffered_copy(src, dst)
+            # The original file could be removed after the copy, so make sure nothing is missing
+            src_size = os.fstat(src.fileno()).st_size
+            dst_size = os.fstat(dst.fileno()).st_size
+            if src_size != dst_size:
+                raise IOError(
+                    errno.EIO, "Incomplete copy of %s: %s of %s bytes copied" % (src_path, dst_size, src_size)
+                )
+    shutil.copystat(src_path, dst_path)
+
+
 def _copy_grub_files(required, optional):
     """Copy grub files from centos/ dir to the /boot/efi/EFI/redhat/ dir.
 
@@ -330,38 +484,44 @@ def _copy_grub_files(required, optional):
     The copy of the centos/ directory should be ok. In case of the conversion
     from Oracle Linux, the redhat/ directory is already used.
 
-    Return False when any required file has not been copied or is missing.
-    """
-    if systeminfo.system_info.id != "centos":
-        logger.debug("Skipping copying GRUB files - only related to CentOS Linux.")
-        return True
+    Expected to be called only on CentOS Linux.
 
+    Return tuple (flag_ok, copied_files):
+      - flag_ok is False when any required file has not been copied or is missing,
+      - copied_files is the list of names of files copied by this call.
+    """
     # TODO(pstodulk): check behaviour for efibin from a different dir or with a different name for the possibility of
     #  the different grub content...
     # E.g. if the efibin is located in a different directory, are these two files valid?
     logger.info("Copying GRUB2 configuration files to the new UEFI directory %s." % RHEL_EFIDIR_CANONICAL_PATH)
     flag_ok = True
+    copied_files = []
     all_files = required + optional
+    required_files = frozenset(required)
+    src_entries = _get_dir_entries(CENTOS_EFIDIR_CANONICAL_PATH)
+    dst_entries = _get_dir_entries(RHEL_EFIDIR_CANONICAL_PATH)
     for filename in all_files:
         src_path = os.path.join(CENTOS_EFIDIR_CANONICAL_PATH, filename)
         dst_path = os.path.join(RHEL_EFIDIR_CANONICAL_PATH, filename)
-        if os.path.exists(dst_path):
+        if filename.lower() in dst_entries:
             logger.debug("The %s file already exists. Copying skipped." % dst_path)
             continue
-        if not os.path.exists(src_path):
-            if filename in required:
+        if filename.lower() not in src_entries:
+            if filename in required_files:
                 # without the required files user should not reboot the system
                 logger.error("Unable to find the original file required for GRUB configuration: %s" % src_path)
                 flag_ok = False
             continue
         logger.info("Copying '%s' to '%s'" % (src_path, dst_path))
         try:
-            shutil.copy2(src_path, dst_path)
+            _copy_file(src_path, dst_path)
         except (OSError, IOError) as err:
             # IOError for py2 and OSError for py3
             logger.error("I/O error(%s): %s" % (err.errno, err.strerror))
             flag_ok = False
-    return flag_ok
+            continue
+        copied_files.append(filename)
+    return flag_ok, copied_files
 
 
 def _is_rhel_in_boot_entries(efibootinfo, efi_path, label):
@@ -375,30 +535,29 @@ def _is_rhel_in_boot_entries(efibootinfo, efi_path, label):
     return False
 
 
-def _add_rhel_boot_entry(efibootinfo_orig):
+def _add_rhel_boot_entry(efibootinfo_orig, efibin_path):
     """
     Create a new UEFI bootloader entry with a RHEL label and bin file.
 
+    The efibin_path is the canonical path of the existing RHEL UEFI binary
+    the new entry will refer to.
+
     If an entry for the label and bin file already exists no new entry
     will be created.
 
     Return the new bootloader info (EFIBootInfo).
     """
-    dev_number = _get_device_number(get_efi_partition())
-    blk_dev = get_grub_device()
+    # The UEFI has been detected already. Get the ESP just once and derive the
+    # block device from it as get_grub_device() would probe the ESP again.
+    efi_partition = get_efi_partition()
+    dev_number = _get_device_number(efi_partition)
+    blk_dev = _get_blk_device(efi_partition)
 
     logger.debug("Block device: %s" % str(blk_dev))
     logger.debug("ESP device number: %s" % str(dev_number))
 
-    efi_path = None
-    for filename in DEFAULT_INSTALLED_EFIBIN_FILENAMES:
-        tmp_efi_path = os.path.join(RHEL_EFIDIR_CANONICAL_PATH, filename)
-        if os.path.exists(tmp_efi_path):
-            efi_path = canonical_path_to_efi_format(tmp_efi_path)
-            logger.debug("The new UEFI binary: %s" % tmp_efi_path)
-            break
-    if not efi_path:
-        raise BootloaderError("Unable to detect any RHEL UEFI binary file.")
+    efi_path = canonical_path_to_efi_format(efibin_path)
+    logger.debug("The new UEFI binary: %s" % efibin_path)
 
     label = "Red Hat Enterprise Linux %s" % str(systeminfo.system_info.version.major)
     logger.info("Adding '%s' UEFI bootloader entry." % label)
@@ -494,12 +653,13 @@ def _remove_orig_boot_entry(efibootinfo_orig, efibootinfo_new):
     )
 
 
-def _replace_efi_boot_entry():
+def _replace_efi_boot_entry(efibin_path):
     """Replace the current UEFI bootloader entry with the RHEL one.
 
     The current UEFI bootloader entry could be invalid or misleading. It's
     expected that the new bootloader entry will refer to one of the standard UEFI binary
-    files provided by Red Hat inside the RHEL_EFIDIR_CANONICAL_PATH.
+    files provided by Red Hat inside the RHEL_EFIDIR_CANONICAL_PATH, passed
+    as efibin_path.
     The new UEFI bootloader entry is always created / registered and set
     set as default.
 
@@ -511,33 +671,60 @@ def _replace_efi_boot_entry():
     efibootinfo_orig = EFIBootInfo()
 
     logger.info("Adding a new UEFI bootloader entry for RHEL.")
-    efibootinfo_new = _add_rhel_boot_entry(efibootinfo_orig)
+    efibootinfo_new = _add_rhel_boot_entry(efibootinfo_orig, efibin_path)
 
     logger.info("Removing the original UEFI bootloader entry.")
     _remove_orig_boot_entry(efibootinfo_orig, efibootinfo_new)
 
 
-def _remove_efi_centos():
+def _remove_efi_centos(copied_files):
     """Remove the /boot/efi/EFI/centos/ directory when no UEFI files remains.
 
     The centos/ directory after the conversion contains usually just grubenv,
     grub.cfg, .. files only. Which we copy into the redhat/ directory. If no
-    other UEFI files are present, we can remove this dir. However, if additional
-    UEFI files are present, we should keep the directory for now, until we
-    deal with it.
+    other files than the copied_files are present, we remove these files and
+    the directory. However, if additional files are present (e.g. UEFI
+    binaries or files that have not been copied by us), we keep the directory
+    untouched for now, until we deal with it.
+
+    Expected to be called only on CentOS Linux.
     """
-    if systeminfo.system_info.id != "centos":
-        # nothing to do
+    copied_entries = set(filename.lower() for filename in copied_files)
+    if _get_dir_entries(CENTOS_EFIDIR_CANONICAL_PATH) - copied_entries:
+        logger.warning(
+            "The folder %s is left untouched. You may remove the folder manually"
+            " after you ensure there is no custom data you would need." % CENTOS_EFIDIR_CANONICAL_PATH
+        )
         return
+
     try:
+        for filename in copied_files:
+            path = os.path.join(CENTOS_EFIDIR_CANONICAL_PATH, filename)
+            logger.debug("Removing the %s file copied to %s." % (path, RHEL_EFIDIR_CANONICAL_PATH))
+            os.unlink(path)
         os.rmdir(CENTOS_EFIDIR_CANONICAL_PATH)
-    except OSError:
+    except OSError as err:
         logger.warning(
-            "The folder %s is left untouched. You may remove the folder manually"
-            " after you ensure there is no custom data you would need." % CENTOS_EFIDIR_CANONICAL_PATH
+            "Unable to remove the folder %s: %s. You may remove the folder manually"
+            " after you ensure there is no custom data you would need." % (CENTOS_EFIDIR_CANONICAL_PATH, err.strerror)
         )
 
 
+def _get_new_default_efibin():
+    """Return the canonical path of the preferred RHEL UEFI binary or None if none exists.
+
+    The binary is detected just once and the result is used by all later steps
+    of the UEFI configuration.
+    """
+    rhel_efidir_entries = _get_dir_entries(RHEL_EFIDIR_CANONICAL_PATH)
+    for filename, efi_path in _DEFAULT_RHEL_EFIBIN_PATHS:
+        if filename.lower() in rhel_efidir_entries:
+            logger.info("UEFI binary found: %s" % efi_path)
+            return efi_path
+        logger.debug("UEFI binary %s not found. Checking next possibility..." % efi_path)
+    return None
+
+
 def post_ponr_set_efi_configuration():
     """Configure GRUB after the conversion.
 
@@ -557,26 +744,22 @@ def post_ponr_set_efi_configuration():
         logger.info("BIOS detected. Nothing to do.")
         return
 
-    new_default_efibin = None
-    for filename in DEFAULT_INSTALLED_EFIBIN_FILENAMES:
-        efi_path = os.path.join(RHEL_EFIDIR_CANONICAL_PATH, filename)
-        if os.path.exists(efi_path):
-            logger.info("UEFI binary found: %s" % efi_path)
-            new_default_efibin = efi_path
-            break
-        logger.debug("UEFI binary %s not found. Checking next possibility..." % efi_path)
+    new_default_efibin = _get_new_default_efibin()
     if not new_default_efibin:
         _log_critical_error("None of the expected RHEL UEFI binaries exist.")
     if not os.path.exists("/usr/sbin/efibootmgr"):
         _log_critical_error("The /usr/sbin/efibootmgr utility is not installed.")
 
-    # related just to CentOS Linux. checks inside
-    if not _copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"]):
-        _log_critical_error("Some GRUB files have not been copied to /boot/efi/EFI/redhat")
-    _remove_efi_centos()
+    if systeminfo.system_info.id == "centos":
+        flag_ok, copied_files = _copy_grub_files(GRUB_REQUIRED_EFI_FILENAMES, GRUB_OPTIONAL_EFI_FILENAMES)
+        if not flag_ok:
+            _log_critical_error("Some GRUB files have not been copied to /boot/efi/EFI/redhat")
+        _remove_efi_centos(copied_files)
+    else:
+        logger.debug("Skipping copying GRUB files - only related to CentOS Linux.")
 
     try:
-        _replace_efi_boot_entry()
+        _replace_efi_boot_entry(new_default_efibin)
     except BootloaderError as e:
         _log_critical_error(e.message)
 
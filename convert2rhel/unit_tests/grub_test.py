@@ -16,6 +16,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import copy
+import errno
+import fcntl
+import io
 import os
 
 from collections import namedtuple
@@ -273,80 +276,323 @@ def test_EFIBootLoader__efi_path_to_canonical():
 
 
 @pytest.mark.parametrize(
-    ("sys_id", "src_file_exists", "dst_file_exists", "log_msg", "ret_value"),
+    ("src_file_exists", "dst_file_exists", "log_msg", "ret_value"),
     (
-        ("oracle", None, None, "only related to CentOS Linux", True),
-        ("centos", None, True, "file already exists", True),
-        ("centos", True, False, "Copying '", True),
-        ("centos", False, False, "Unable to find the original", False),
+        (None, True, "file already exists", True),
+        (True, False, "Copying '", True),
+        (False, False, "Unable to find the original", False),
     ),
 )
-@mock.patch("shutil.copy2")
-@mock.patch("os.path.exists")
-def test__copy_grub_files(
-    mock_path_exists, mock_path_copy2, sys_id, src_file_exists, dst_file_exists, log_msg, ret_value, monkeypatch, caplog
-):
-    def path_exists(path):
-        return src_file_exists if grub.CENTOS_EFIDIR_CANONICAL_PATH in path else dst_file_exists
+@mock.patch("convert2rhel.grub._copy_file")
+@mock.patch("os.listdir")
+def test__copy_grub_files(mock_listdir, mock_copy_file, src_file_exists, dst_file_exists, log_msg, ret_value, caplog):
+    def listdir(path):
+        files_exist = src_file_exists if path == grub.CENTOS_EFIDIR_CANONICAL_PATH else dst_file_exists
+        return ["grubenv", "grub.cfg", "user.cfg"] if files_exist else []
 
-    mock_path_exists.side_effect = path_exists
-    monkeypatch.setattr("convert2rhel.systeminfo.system_info.id", sys_id)
+    mock_listdir.side_effect = listdir
 
-    successful = grub._copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"])
+    successful, copied_files = grub._copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"])
 
     assert any(log_msg in record.message for record in caplog.records)
     assert successful == ret_value
-    if sys_id == "centos" and src_file_exists and not dst_file_exists:
-        assert mock_path_copy2.call_args_list == [
+    if src_file_exists and not dst_file_exists:
+        assert mock_copy_file.call_args_list == [
             mock.call("/boot/efi/EFI/centos/grubenv", "/boot/efi/EFI/redhat/grubenv"),
             mock.call("/boot/efi/EFI/centos/grub.cfg", "/boot/efi/EFI/redhat/grub.cfg"),
             mock.call("/boot/efi/EFI/centos/user.cfg", "/boot/efi/EFI/redhat/user.cfg"),
         ]
+        assert copied_files == ["grubenv", "grub.cfg", "user.cfg"]
+    else:
+        assert copied_files == []
+
+
+def test__copy_grub_files_copy_fails(monkeypatch, caplog):
+    def copy_file(src_path, dst_path):
+        if src_path.endswith("grub.cfg"):
+            raise IOError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr("os.listdir", mock.Mock(side_effect=[["grubenv", "grub.cfg", "user.cfg"], []]))
+    monkeypatch.setattr("convert2rhel.grub._copy_file", mock.Mock(side_effect=copy_file))
+
+    assert grub._copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"]) == (False, ["grubenv", "user.cfg"])
+    assert any("No space left on device" in record.message for record in caplog.records)
+
+
+@mock.patch("convert2rhel.grub._copy_file")
+def test__copy_grub_files_case_insensitive(mock_copy_file, monkeypatch):
+    # the ESP is a FAT filesystem, so the files could be stored in uppercase
+    def listdir(path):
+        return ["GRUBENV", "GRUB.CFG"] if path == grub.CENTOS_EFIDIR_CANONICAL_PATH else ["GRUB.CFG"]
+
+    monkeypatch.setattr("os.listdir", mock.Mock(side_effect=listdir))
+
+    assert grub._copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"]) == (True, ["grubenv"])
+    assert mock_copy_file.call_args_list == [
+        mock.call("/boot/efi/EFI/centos/grubenv", "/boot/efi/EFI/redhat/grubenv"),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("content",),
+    (
+        (b"",),
+        (b"set default=0\n",),
+        (b"x" * (grub.COPY_BUFSIZE * 2 + 1),),
+    ),
+)
+def test__copy_file(content, tmpdir):
+    src_path = str(tmpdir / "grubenv")
+    dst_path = str(tmpdir / "grubenv.copy")
+    with open(src_path, "wb") as f:
+        f.write(content)
+    os.chmod(src_path, 0o600)
+
+    grub._copy_file(src_path, dst_path)
+
+    with open(dst_path, "rb") as f:
+        assert f.read() == content
+    assert os.stat(dst_path).st_mode == os.stat(src_path).st_mode
+    assert os.stat(dst_path).st_mtime == os.stat(src_path).st_mtime
+
+
+@pytest.mark.parametrize(
+    ("has_copy_file_range", "has_sendfile", "content"),
+    (
+        (True, True, b"set default=0\n"),
+        (False, True, b"set default=0\n"),
+        (False, False, b"set default=0\n"),
+        # the buffered copy (the only one used on Python 2) has to loop over multiple chunks
+        (False, False, b"x" * (grub.COPY_BUFSIZE * 2 + 1)),
+    ),
+)
+def test__copy_file_no_kernel_copy(has_copy_file_range, has_sendfile, content, monkeypatch, tmpdir):
+    # the copy has to succeed on Pythons without some (or any) of the copy syscalls
+    monkeypatch.setattr("fcntl.ioctl", mock.Mock(side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported")))
+    unsupported = mock.Mock(side_effect=OSError(errno.ENOSYS, "Function not implemented"))
+    if has_copy_file_range:
+        monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    else:
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+    if has_sendfile:
+        monkeypatch.setattr(os, "sendfile", unsupported, raising=False)
+    else:
+        monkeypatch.delattr(os, "sendfile", raising=False)
+    src_path = str(tmpdir / "grub.cfg")
+    dst_path = str(tmpdir / "grub.cfg.copy")
+    with open(src_path, "wb") as f:
+        f.write(content)
+
+    grub._copy_file(src_path, dst_path)
+
+    with open(dst_path, "rb") as f:
+        assert f.read() == content
+    assert unsupported.call_count == has_copy_file_range + has_sendfile
+
+
+def test__copy_grub_files_incomplete_copy(monkeypatch, tmpdir):
+    # an incomplete copy must not be reported as copied, otherwise the original would be removed
+    centos_dir = tmpdir.mkdir("centos")
+    rhel_dir = tmpdir.mkdir("redhat")
+    for filename in ("grubenv", "grub.cfg"):
+        with open(str(centos_dir / filename), "wb") as f:
+            f.write(b"set default=0\n")
+    monkeypatch.setattr("convert2rhel.grub.CENTOS_EFIDIR_CANONICAL_PATH", str(centos_dir))
+    monkeypatch.setattr("convert2rhel.grub.RHEL_EFIDIR_CANONICAL_PATH", str(rhel_dir))
+    monkeypatch.setattr("fcntl.ioctl", mock.Mock(side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported")))
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile", raising=False)
+
+    def buffered_copy(src, dst):
+        data = src.read()
+        dst.write(data if src.name.endswith("grubenv") else data[:4])
+
+    monkeypatch.setattr("convert2rhel.grub._buffered_copy", mock.Mock(side_effect=buffered_copy))
+
+    assert grub._copy_grub_files(["grubenv", "grub.cfg"], ["user.cfg"]) == (False, ["grubenv"])
+
+
+def test__buffered_copy_short_write():
+    content = b"x" * (grub.COPY_BUFSIZE + 10)
+    src = io.BytesIO(content)
+    dst = io.BytesIO()
+    real_write = dst.write
+
+    def short_write(data):
+        # write at most 1000 bytes at once, like a raw write on a filling up filesystem
+        return real_write(bytes(data[:1000]))
+
+    dst.write = mock.Mock(side_effect=short_write)
+
+    grub._buffered_copy(src, dst)
+
+    assert dst.getvalue() == content
+    assert dst.write.call_count > 2
+
+
+@pytest.mark.parametrize(
+    ("listdir_res", "expected_res"),
+    (
+        (["grubenv", "grub.cfg"], set(["grubenv", "grub.cfg"])),
+        (["GRUBENV", "Grub.cfg"], set(["grubenv", "grub.cfg"])),
+        ([], set()),
+        (OSError(errno.ENOENT, "No such file or directory"), set()),
+    ),
+)
+def test__get_dir_entries(listdir_res, expected_res, monkeypatch):
+    monkeypatch.setattr("os.listdir", mock.Mock(side_effect=[listdir_res]))
+
+    assert grub._get_dir_entries(grub.CENTOS_EFIDIR_CANONICAL_PATH) == expected_res
+    os.listdir.assert_called_once_with(grub.CENTOS_EFIDIR_CANONICAL_PATH)
+
+
+@pytest.mark.parametrize(
+    ("ioctl_exc", "expected_res"),
+    (
+        (None, True),
+        (OSError(errno.EOPNOTSUPP, "Operation not supported"), False),
+        (IOError(errno.EXDEV, "Invalid cross-device link"), False),
+        (IOError(errno.ENOTTY, "Inappropriate ioctl for device"), False),
+    ),
+)
+def test__reflink(ioctl_exc, expected_res, monkeypatch):
+    monkeypatch.setattr("fcntl.ioctl", mock.Mock(side_effect=ioctl_exc))
+
+    assert grub._reflink(3, 4) == expected_res
+    fcntl.ioctl.assert_called_once_with(4, grub._FICLONE, 3)
+
+
+def test__reflink_error(monkeypatch):
+    monkeypatch.setattr("fcntl.ioctl", mock.Mock(side_effect=OSError(errno.ENOSPC, "No space left on device")))
+
+    with pytest.raises(OSError):
+        grub._reflink(3, 4)
 
 
 @pytest.mark.parametrize(
-    ("sys_id", "remove_dir", "empty_dir"),
+    ("copied_sizes", "src_size", "expected_res"),
     (
-        ("oracle", False, True),
-        ("centos", True, True),
-        ("centos", True, False),
+        ([4, 0], 4, True),
+        ([0], 0, True),
+        # nothing copied from a non-empty file without any error
+        ([0], 4, False),
+    ),
+)
+def test__kernel_copy(copied_sizes, src_size, expected_res, monkeypatch):
+    copy_func = mock.Mock(side_effect=copied_sizes)
+    monkeypatch.setattr("os.fstat", mock.Mock(return_value=mock.Mock(st_size=src_size)))
+
+    assert grub._kernel_copy(copy_func, 3, 4) == expected_res
+    assert copy_func.call_count == len(copied_sizes)
+
+
+def test__copy_file_kernel_copy_copies_nothing(monkeypatch, tmpdir):
+    monkeypatch.setattr("fcntl.ioctl", mock.Mock(side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported")))
+    monkeypatch.setattr("convert2rhel.grub._copy_file_range", mock.Mock(return_value=0))
+    monkeypatch.setattr("convert2rhel.grub._sendfile", mock.Mock(return_value=0))
+    monkeypatch.setattr(os, "copy_file_range", mock.Mock(), raising=False)
+    monkeypatch.setattr(os, "sendfile", mock.Mock(), raising=False)
+    src_path = str(tmpdir / "grub.cfg")
+    dst_path = str(tmpdir / "grub.cfg.copy")
+    with open(src_path, "wb") as f:
+        f.write(b"set default=0\n")
+
+    grub._copy_file(src_path, dst_path)
+
+    with open(dst_path, "rb") as f:
+        assert f.read() == b"set default=0\n"
+    grub._copy_file_range.assert_called_once()
+    grub._sendfile.assert_called_once()
+
+
+def test__kernel_copy_error():
+    copy_func = mock.Mock(side_effect=[4, OSError(errno.ENOSPC, "No space left on device")])
+
+    with pytest.raises(OSError):
+        grub._kernel_copy(copy_func, 3, 4)
+    assert copy_func.call_args_list == [mock.call(3, 4, 0), mock.call(3, 4, 4)]
+
+
+@pytest.mark.parametrize(
+    ("centos_files", "copied_files", "unlink_exc", "removed_files", "remove_dir", "log_msg"),
+    (
+        ([], [], None, [], True, None),
+        (["grubenv", "grub.cfg"], ["grubenv", "grub.cfg"], None, ["grubenv", "grub.cfg"], True, None),
+        (["GRUBENV"], ["grubenv"], None, ["grubenv"], True, None),
+        # grub.cfg has not been copied by us (e.g. it has been present in redhat/ already)
+        (["grubenv", "grub.cfg"], ["grubenv"], None, [], False, "left untouched"),
+        (["grubenv", "shimx64.efi"], ["grubenv"], None, [], False, "left untouched"),
+        (
+            ["grubenv", "grub.cfg"],
+            ["grubenv", "grub.cfg"],
+            OSError(errno.EACCES, "Permission denied"),
+            ["grubenv"],
+            False,
+            "Unable to remove the folder",
+        ),
     ),
 )
-def test__remove_efi_centos(sys_id, remove_dir, empty_dir, monkeypatch, caplog):
+def test__remove_efi_centos(
+    centos_files, copied_files, unlink_exc, removed_files, remove_dir, log_msg, monkeypatch, caplog
+):
+    monkeypatch.setattr("os.listdir", mock.Mock(return_value=centos_files))
+    monkeypatch.setattr("os.unlink", mock.Mock(side_effect=unlink_exc))
     monkeypatch.setattr("os.rmdir", mock.Mock())
-    monkeypatch.setattr("convert2rhel.systeminfo.system_info.id", sys_id)
-    if not empty_dir:
-        os.rmdir.side_effect = OSError()
 
-    grub._remove_efi_centos()
+    grub._remove_efi_centos(copied_files)
 
+    os.listdir.assert_called_once_with(grub.CENTOS_EFIDIR_CANONICAL_PATH)
+    assert os.unlink.call_args_list == [
+        mock.call(os.path.join(grub.CENTOS_EFIDIR_CANONICAL_PATH, filename)) for filename in removed_files
+    ]
     if remove_dir:
-        os.rmdir.assert_called_once()
+        os.rmdir.assert_called_once_with(grub.CENTOS_EFIDIR_CANONICAL_PATH)
     else:
         os.rmdir.assert_not_called()
+        assert log_msg in caplog.records[-1].message
+
+
+def test__remove_efi_centos_rmdir_fails(monkeypatch, caplog):
+    monkeypatch.setattr("os.listdir", mock.Mock(return_value=[]))
+    monkeypatch.setattr("os.rmdir", mock.Mock(side_effect=OSError(errno.ENOTEMPTY, "Directory not empty")))
+
+    grub._remove_efi_centos([])
 
-    if not empty_dir:
-        assert "left untouched" in caplog.records[-1].message
+    os.rmdir.assert_called_once()
+    assert "Unable to remove the folder" in caplog.records[-1].message
 
 
 @pytest.mark.parametrize(
-    ("is_efi", "efi_file_exists", "copy_files_ok", "replace_entry_exc", "raise_exc", "log_msg"),
+    ("sys_id", "is_efi", "efi_file_exists", "copy_files_ok", "replace_entry_exc", "raise_exc", "log_msg"),
     (
-        (False, None, None, None, False, "BIOS detected"),
-        (True, False, None, None, True, "None of the expected"),
-        (True, True, False, None, True, "not been copied"),
-        (True, True, True, None, False, "UEFI binary found"),
-        (True, True, True, grub.EFINotUsed("No ESP."), True, "No ESP.\nThe migration"),
-        (True, True, True, grub.UnsupportedEFIConfiguration("Not mounted."), True, "Not mounted.\nThe migration"),
-        (True, True, True, grub.BootloaderError("No device."), True, "No device.\nThe migration"),
+        ("centos", False, None, None, None, False, "BIOS detected"),
+        ("centos", True, False, None, None, True, "None of the expected"),
+        ("centos", True, True, False, None, True, "not been copied"),
+        ("centos", True, True, True, None, False, "UEFI binary found"),
+        ("oracle", True, True, None, None, False, "only related to CentOS Linux"),
+        ("centos", True, True, True, grub.EFINotUsed("No ESP."), True, "No ESP.\nThe migration"),
+        (
+            "centos",
+            True,
+            True,
+            True,
+            grub.UnsupportedEFIConfiguration("Not mounted."),
+            True,
+            "Not mounted.\nThe migration",
+        ),
+        ("centos", True, True, True, grub.BootloaderError("No device."), True, "No device.\nThe migration"),
     ),
 )
 def test_post_ponr_set_efi_configuration(
-    is_efi, efi_file_exists, copy_files_ok, replace_entry_exc, raise_exc, log_msg, caplog, monkeypatch
+    sys_id, is_efi, efi_file_exists, copy_files_ok, replace_entry_exc, raise_exc, log_msg, caplog, monkeypatch
 ):
+    monkeypatch.setattr("convert2rhel.systeminfo.system_info.id", sys_id)
     monkeypatch.setattr("os.path.exists", mock.Mock(return_value=efi_file_exists))
+    monkeypatch.setattr(
+        "os.listdir", mock.Mock(return_value=list(grub.DEFAULT_INSTALLED_EFIBIN_FILENAMES) if efi_file_exists else [])
+    )
     monkeypatch.setattr("convert2rhel.grub.is_efi", mock.Mock(return_value=is_efi))
-    monkeypatch.setattr("convert2rhel.grub._copy_grub_files", mock.Mock(return_value=copy_files_ok))
+    monkeypatch.setattr("convert2rhel.grub._copy_grub_files", mock.Mock(return_value=(copy_files_ok, ["grubenv"])))
     monkeypatch.setattr("convert2rhel.grub._remove_efi_centos", mock.Mock())
     monkeypatch.setattr("convert2rhel.grub._replace_efi_boot_entry", mock.Mock())
     if replace_entry_exc:
@@ -361,8 +607,28 @@ def test_post_ponr_set_efi_configuration(
     assert log_msg in caplog.records[-1].message
 
     if is_efi and efi_file_exists and copy_files_ok and not replace_entry_exc:
-        grub._remove_efi_centos.assert_called_once()
-        grub._replace_efi_boot_entry.assert_called_once()
+        grub._remove_efi_centos.assert_called_once_with(["grubenv"])
+        grub._replace_efi_boot_entry.assert_called_once_with("/boot/efi/EFI/redhat/shimx64.efi")
+    if sys_id != "centos":
+        grub._copy_grub_files.assert_not_called()
+        grub._remove_efi_centos.assert_not_called()
+        grub._replace_efi_boot_entry.assert_called_once_with("/boot/efi/EFI/redhat/shimx64.efi")
+
+
+@pytest.mark.parametrize(
+    ("rhel_files", "expected_res"),
+    (
+        (["shimx64.efi", "grubx64.efi", "grub.cfg"], "/boot/efi/EFI/redhat/shimx64.efi"),
+        (["grubx64.efi", "grub.cfg"], "/boot/efi/EFI/redhat/grubx64.efi"),
+        (["SHIMX64.EFI", "GRUB.CFG"], "/boot/efi/EFI/redhat/shimx64.efi"),
+        (["grub.cfg"], None),
+    ),
+)
+def test__get_new_default_efibin(rhel_files, expected_res, monkeypatch):
+    monkeypatch.setattr("os.listdir", mock.Mock(return_value=rhel_files))
+
+    assert grub._get_new_default_efibin() == expected_res
+    os.listdir.assert_called_once_with(grub.RHEL_EFIDIR_CANONICAL_PATH)
 
 
 EFIBOOTMGR_VERBOSE_OUTPUT = r"""
@@ -469,33 +735,34 @@ def test__is_rhel_in_boot_entries(efi_bin_path, label, expected_ret_val):
 
 
 @pytest.mark.parametrize(
-    ("efi_file_exists", "exc", "exc_msg", "rhel_entry_exists", "subproc", "log_msg"),
+    ("exc", "exc_msg", "rhel_entry_exists", "subproc", "log_msg"),
     (
-        (True, None, None, True, ("out", 0), "UEFI bootloader entry is already"),
-        (True, grub.BootloaderError, "Unable to add a new", False, ("out", 1), None),
-        (True, grub.BootloaderError, "Unable to find the new", False, ("out", 0), None),
-        (False, grub.BootloaderError, "Unable to detect any", False, ("out", 0), None),
+        (None, None, True, ("out", 0), "UEFI bootloader entry is already"),
+        (grub.BootloaderError, "Unable to add a new", False, ("out", 1), None),
+        (grub.BootloaderError, "Unable to find the new", False, ("out", 0), None),
     ),
 )
-def test__add_rhel_boot_entry(efi_file_exists, exc, exc_msg, rhel_entry_exists, subproc, log_msg, monkeypatch, caplog):
+def test__add_rhel_boot_entry(exc, exc_msg, rhel_entry_exists, subproc, log_msg, monkeypatch, caplog):
     monkeypatch.setattr("convert2rhel.grub._get_device_number", mock.Mock(return_value={"major": 252, "minor": 1}))
     monkeypatch.setattr("convert2rhel.systeminfo.system_info.version", namedtuple("Version", ["major", "minor"])(8, 5))
     monkeypatch.setattr("convert2rhel.grub.get_efi_partition", mock.Mock(return_value="/dev/sda"))
-    monkeypatch.setattr("convert2rhel.grub.get_grub_device", mock.Mock(return_value="/dev/sda"))
-    monkeypatch.setattr("os.path.exists", mock.Mock(return_value=efi_file_exists))
+    monkeypatch.setattr("convert2rhel.grub._get_blk_device", mock.Mock(return_value="/dev/sda"))
     monkeypatch.setattr("convert2rhel.grub._is_rhel_in_boot_entries", mock.Mock(return_value=rhel_entry_exists))
     monkeypatch.setattr("convert2rhel.utils.run_subprocess", mock.Mock(return_value=subproc))
     monkeypatch.setattr("convert2rhel.grub.EFIBootInfo", EFIBootInfoMocked())
 
     if exc:
         with pytest.raises(exc) as exc_info:
-            grub._add_rhel_boot_entry("test_arg")
+            grub._add_rhel_boot_entry("test_arg", "/boot/efi/EFI/redhat/shimx64.efi")
         assert exc_msg in str(exc_info.value)
     else:
-        grub._add_rhel_boot_entry("test_arg")
+        grub._add_rhel_boot_entry("test_arg", "/boot/efi/EFI/redhat/shimx64.efi")
         assert log_msg in caplog.records[-1].message
-    if efi_file_exists and not rhel_entry_exists:
+    if not rhel_entry_exists:
         utils.run_subprocess.assert_called_once()
+        assert "\\EFI\\redhat\\shimx64.efi" in utils.run_subprocess.call_args[0][0]
+    grub.get_efi_partition.assert_called_once()
+    grub._get_blk_device.assert_called_once_with("/dev/sda")
 
 
 @pytest.mark.parametrize(